@@ -0,0 +1,265 @@
+# توليد التست كيسات لعدد كبير من الـ User Stories بدون واجهة Flask
+#
+# أمثلة:
+#   python batch_generate.py --ids-file stories.txt --output results.jsonl --workers 4
+#   python batch_generate.py --wiql "SELECT [System.Id] FROM WorkItems WHERE [System.WorkItemType] = 'Product Backlog Item'" --dry-run
+#
+# الـ checkpoint ملف JSONL بيتكتب فيه كل خطوة (توليد، إنشاء، خطوات، ربط)؛ لو البرنامج وقع أو
+# اتعمل Ctrl-C، التشغيل التاني بنفس الـ checkpoint بيكمل من مكانه من غير ما يكرر الإنشاء على Azure.
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from app import (
+    AsyncAzureClient,
+    criteria_snapshot,
+    extract_story_id,
+    generate_test_cases_with_usage,
+    generation_warnings,
+    get_user_story_details,
+    load_test_cases_history,
+    push_test_case,
+    save_test_cases_history,
+)
+
+class Checkpoint:
+    """سجل append-only للتقدم؛ بيتقري كله عند البداية وكل حدث بيتعمله fsync."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.stories = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        # آخر سطر ممكن يكون ناقص لو البرنامج وقع أثناء الكتابة
+                        continue
+        self.file = open(path, "a", encoding="utf-8")
+
+    def story(self, story_id):
+        return self.stories.setdefault(str(story_id), {"done": None, "test_cases": None, "usage": [], "pushed": {}})
+
+    def apply(self, event):
+        story = self.story(event["story_id"])
+        if event["event"] == "generated":
+            story["test_cases"] = event["test_cases"]
+            story["usage"] = event.get("usage", [])
+        elif event["event"] == "pushed":
+            # stage = tc["push_stage"] بتاع app.push_test_case، و None لما الحالة تكمل
+            # (الـ checkpoints القديمة كانت بتسجل "linked")
+            stage = event.get("stage")
+            story["pushed"][event["index"]] = {"azure_id": event["azure_id"], "stage": None if stage == "linked" else stage}
+        elif event["event"] == "done":
+            story["done"] = "dry_run" if event.get("dry_run") else "pushed"
+
+    def record(self, **event):
+        with self.lock:
+            self.file.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.apply(event)
+
+    def is_done(self, story_id, dry_run):
+        done = self.stories.get(str(story_id), {}).get("done")
+        return done == "pushed" or (dry_run and done == "dry_run")
+
+    def close(self):
+        self.file.close()
+
+class BatchRunner:
+    def __init__(self, checkpoint, output_path, dry_run=False):
+        self.checkpoint = checkpoint
+        self.dry_run = dry_run
+        self.output = open(output_path, "a", encoding="utf-8")
+        self.output_lock = threading.Lock()
+        self.history_lock = threading.Lock()
+        self.stats = {"processed": 0, "succeeded": 0, "failed": 0, "skipped": 0, "duplicates": 0, "test_cases": 0, "pushed": 0, "tokens": 0}
+        self.stats_lock = threading.Lock()
+
+    def count(self, **deltas):
+        with self.stats_lock:
+            for key, value in deltas.items():
+                self.stats[key] += value
+
+    def write_result(self, result):
+        with self.output_lock:
+            self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self.output.flush()
+
+    # رفع التست كيس بـ app.push_test_case مع تسجيل azure_id/push_stage بعد كل مرحلة؛
+    # المراحل اللي خلصت في تشغيل سابق بتتخطى
+    def push_test_case(self, story_id, index, tc):
+        progress = self.checkpoint.story(story_id)["pushed"].get(index)
+        if progress:
+            tc["azure_id"] = progress["azure_id"]
+            if progress["stage"] is None:
+                tc.pop("push_stage", None)
+                return "pushed"
+            tc["push_stage"] = progress["stage"]
+
+        def checkpoint_stage(tc):
+            self.checkpoint.record(event="pushed", story_id=story_id, index=index, azure_id=tc["azure_id"], stage=tc.get("push_stage"))
+
+        return push_test_case(story_id, tc, on_stage=checkpoint_stage)
+
+    def append_history(self, story, test_cases):
+        with self.history_lock:
+            history = load_test_cases_history()
+            history.append({
+                "story_id": story["id"],
+                "story_title": story.get("title", ""),
+                "created_at": time.strftime("%Y-%m-%d %H:%M"),
+                "criteria": criteria_snapshot(story["acceptance"]),
+                "test_cases": [dict(tc, generated=True) for tc in test_cases]
+            })
+            save_test_cases_history(history)
+
+    def process(self, story_id):
+        start = time.monotonic()
+        result = {"story_id": story_id, "status": "success", "dry_run": self.dry_run}
+        try:
+            story = get_user_story_details(story_id)
+            result["title"] = story.get("title", "")
+            if "Could not fetch" in story["description"]:
+                raise RuntimeError(story["description"])
+            if not story["description"] or not story["acceptance"]:
+                raise RuntimeError("Description or acceptance criteria is empty or invalid.")
+
+            # لو التوليد اتعمل قبل كده نستخدم نفس التست كيسات عشان المراحل المسجلة تفضل صحيحة
+            saved = self.checkpoint.story(story_id)
+            if saved["test_cases"] is None:
+                test_cases, usage = generate_test_cases_with_usage(story["description"], story["acceptance"])
+                for tc in test_cases:
+                    tc["story_id"] = story_id
+                    tc.setdefault("expected_result", "No expected result provided")
+                self.checkpoint.record(event="generated", story_id=story_id, test_cases=test_cases, usage=usage)
+                self.count(tokens=sum(u.get("total_tokens", 0) for u in usage))
+            test_cases, usage = saved["test_cases"], saved["usage"]
+            result["usage"] = usage
+            result["warnings"] = generation_warnings(usage)
+            self.count(test_cases=len(test_cases))
+
+            if not self.dry_run:
+                failed = partial = 0
+                for index, tc in enumerate(test_cases):
+                    push_status = self.push_test_case(story_id, index, tc)
+                    if push_status == "pushed":
+                        self.count(pushed=1)
+                    elif push_status == "partial":
+                        partial += 1
+                    else:
+                        failed += 1
+                if failed or partial:
+                    raise RuntimeError(
+                        f"{failed} of {len(test_cases)} test cases could not be pushed to Azure "
+                        f"and {partial} were only partially created; run again to resume them."
+                    )
+                self.append_history(story, test_cases)
+
+            self.checkpoint.record(event="done", story_id=story_id, dry_run=self.dry_run)
+            result["test_cases"] = test_cases
+            self.count(succeeded=1)
+        except Exception as e:
+            result.update(status="error", error=str(e))
+            self.count(failed=1)
+        result["elapsed"] = round(time.monotonic() - start, 2)
+        self.count(processed=1)
+        self.write_result(result)
+        print(f"[{result['status']}] {story_id} ({result['elapsed']}s)")
+        return result
+
+    def run(self, story_ids, workers):
+        # بنقدّم عدد محدود من المهام في نفس الوقت عشان الإدخال يتقري stream
+        executor = ThreadPoolExecutor(max_workers=workers)
+        pending = set()
+        # نفس القصة ممكن تتكرر في الإدخال (رقم مرة ورابط مرة)؛ لو اتبعتت لعاملين هتتعمل على Azure مرتين
+        seen = set()
+        try:
+            for story_id in story_ids:
+                if story_id in seen:
+                    self.count(duplicates=1)
+                    continue
+                seen.add(story_id)
+                if self.checkpoint.is_done(story_id, self.dry_run):
+                    self.count(skipped=1)
+                    continue
+                if len(pending) >= workers * 2:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                pending.add(executor.submit(self.process, story_id))
+            wait(pending)
+        except KeyboardInterrupt:
+            print("Interrupted; cancelling queued stories and waiting for the running ones to finish so their progress is checkpointed...")
+            for future in pending:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.output.close()
+
+def read_ids_file(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            story_id = extract_story_id(line)
+            if story_id:
+                yield story_id
+            else:
+                print(f"Skipping invalid story reference: {line}")
+
+def query_story_ids(query, project):
+    async def run():
+        async with AsyncAzureClient() as azure:
+            return await azure.query_work_item_ids(query, project)
+    return [str(story_id) for story_id in asyncio.run(run())]
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate test cases for many user stories without the web UI.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--ids-file", help="File with one story ID or work item URL per line")
+    source.add_argument("--wiql", help="WIQL query selecting the story IDs")
+    parser.add_argument("--project", default=os.getenv("AZURE_PROJECT"), help="Project used for the WIQL query")
+    parser.add_argument("--output", default="batch_results.jsonl", help="JSONL file receiving one result line per story")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <output>.checkpoint)")
+    parser.add_argument("--workers", type=int, default=4, help="Number of stories processed in parallel")
+    parser.add_argument("--dry-run", action="store_true", help="Generate only; skip all Azure writes")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    story_ids = read_ids_file(args.ids_file) if args.ids_file else query_story_ids(args.wiql, args.project)
+    checkpoint = Checkpoint(args.checkpoint or f"{args.output}.checkpoint")
+    runner = BatchRunner(checkpoint, args.output, dry_run=args.dry_run)
+    start = time.monotonic()
+    interrupted = False
+    try:
+        runner.run(story_ids, max(1, args.workers))
+    except KeyboardInterrupt:
+        interrupted = True
+    finally:
+        checkpoint.close()
+
+    elapsed = time.monotonic() - start
+    stats = runner.stats
+    rate = stats["processed"] / elapsed * 60 if elapsed else 0
+    print(
+        f"\nProcessed {stats['processed']} stories in {elapsed:.1f}s ({rate:.1f} stories/min): "
+        f"{stats['succeeded']} succeeded, {stats['failed']} failed, {stats['skipped']} already done, {stats['duplicates']} duplicate inputs ignored. "
+        f"{stats['test_cases']} test cases, {stats['pushed']} pushed to Azure, {stats['tokens']} tokens."
+    )
+    if interrupted:
+        print("Interrupted; run the same command again to resume.")
+        return 130
+    return 1 if stats["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())